@@ -3,6 +3,10 @@
 import csv
 from datetime import datetime
 
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pacsv
+
 # --- Configuration ---
 INPUT_FILENAME = 'freelibre_readings_glucose.csv'
 OUTPUT_FILENAME = 'freelibre_scans_1847_to_1927.csv'
@@ -17,8 +21,33 @@ FINAL_COLUMNS = ['Device Timestamp', 'Scan Glucose (mmol/L)']
 # 3. Column names to find in the source file
 TIMESTAMP_COLUMN = 'Device Timestamp'
 SCAN_GLUCOSE_COLUMN = 'Scan Glucose mmol/L' # We only care about this glucose column now
+
+# 4. Read in large blocks so big exports are tokenized in few passes
+READ_BLOCK_SIZE = 16 * 1024 * 1024
 # ---------------------
 
+def read_ragged_rows(rows):
+    """
+    Extracts the timestamp and scan glucose fields of rows whose field count differs from the header.
+
+    PyArrow rejects such rows, but when a row still reaches both columns they are read by position,
+    as csv.reader did. Empty fields become nulls like in the main read.
+
+    Returns:
+        The extracted fields as a table, and the number of rows too short to hold them.
+    """
+    with open(INPUT_FILENAME, mode='r', encoding='utf-8', newline='') as infile:
+        next(infile) # Skip the first metadata line
+        header = next(csv.reader(infile))
+    ts_idx = header.index(TIMESTAMP_COLUMN)
+    scan_gluc_idx = header.index(SCAN_GLUCOSE_COLUMN)
+    fields = [row for row in csv.reader(rows) if len(row) > max(ts_idx, scan_gluc_idx)]
+    table = pa.table({
+        TIMESTAMP_COLUMN: pa.array([row[ts_idx] or None for row in fields], pa.string()),
+        SCAN_GLUCOSE_COLUMN: pa.array([row[scan_gluc_idx] or None for row in fields], pa.string()),
+    })
+    return table, len(rows) - len(fields)
+
 def generate_scan_report():
     """
     Reads a raw FreeStyle Libre CSV, then filters by a specific time window,
@@ -27,77 +56,106 @@ def generate_scan_report():
     # --- 1. Read and Process the Data ---
     print(f"Reading and processing data from '{INPUT_FILENAME}'...")
 
-    processed_data = []
-    try:
-        with open(INPUT_FILENAME, mode='r', encoding='utf-8', newline='') as infile:
-            # Skip the first metadata line
-            next(infile)
-
-            reader = csv.reader(infile)
-            header = next(reader)
-
-            # Find the indices of the columns we need
-            try:
-                ts_idx = header.index(TIMESTAMP_COLUMN)
-                scan_gluc_idx = header.index(SCAN_GLUCOSE_COLUMN)
-            except ValueError as e:
-                print(f"Error: A required column was not found in the header. {e}")
-                return
-
-            # Convert filter times to time objects for comparison
-            start_filter = datetime.strptime(START_TIME_EXCLUSIVE, '%H:%M').time()
-            end_filter = datetime.strptime(END_TIME_INCLUSIVE, '%H:%M').time()
-
-            # Iterate over each row to filter and extract data
-            for row in reader:
-                if not row or not row[ts_idx]: # Skip empty rows
-                    continue
-
-                try:
-                    # Apply the time filter first
-                    record_datetime = datetime.strptime(row[ts_idx], '%d-%m-%Y %H:%M')
-                    record_time = record_datetime.time()
-
-                    if start_filter < record_time <= end_filter:
-                        # Now, check if there is a value ONLY in the Scan Glucose column
-                        glucose_str = row[scan_gluc_idx]
-
-                        if glucose_str: # This ensures we only keep rows with a manual scan
-                            # Store the datetime object for easy sorting
-                            processed_data.append([record_datetime, float(glucose_str)])
-
-                except (ValueError, IndexError):
-                    print(f"Warning: Skipping malformed row: {row}")
-                    continue
+    # Rows with the wrong number of fields would fail the read, so they are set aside and added
+    # back below when they still hold both columns (rows too short for that count as malformed)
+    ragged_rows = []
+    def set_aside_ragged_row(row):
+        ragged_rows.append(row.text)
+        return 'skip'
 
+    try:
+        # Skip the first metadata line and only load the two columns we need.
+        # Both are read as strings so malformed values can be skipped instead of failing the read.
+        table = pacsv.read_csv(
+            INPUT_FILENAME,
+            read_options=pacsv.ReadOptions(skip_rows=1, block_size=READ_BLOCK_SIZE),
+            parse_options=pacsv.ParseOptions(invalid_row_handler=set_aside_ragged_row),
+            convert_options=pacsv.ConvertOptions(
+                include_columns=[TIMESTAMP_COLUMN, SCAN_GLUCOSE_COLUMN],
+                column_types={TIMESTAMP_COLUMN: pa.string(), SCAN_GLUCOSE_COLUMN: pa.string()},
+                strings_can_be_null=True,
+            ),
+        )
+        num_short_rows = 0
+        if ragged_rows:
+            # Appended after the other rows, so among equal timestamps they sort last
+            ragged_table, num_short_rows = read_ragged_rows(ragged_rows)
+            table = pa.concat_tables([table, ragged_table])
     except FileNotFoundError:
         print(f"Error: The file '{INPUT_FILENAME}' was not found.")
         return
+    except KeyError as e:
+        print(f"Error: A required column was not found in the header. {e}")
+        return
     except Exception as e:
         print(f"An error occurred during file processing: {e}")
         return
 
+    # Minute-resolution exports repeat the same timestamp string many times, so each distinct
+    # string is parsed and formatted only once and expanded back through the dictionary indices.
+    # Unparseable values become nulls.
+    timestamp_str = table[TIMESTAMP_COLUMN]
+    timestamp_codes = pc.dictionary_encode(timestamp_str.combine_chunks())
+    unique_datetimes = pc.strptime(timestamp_codes.dictionary, format='%d-%m-%Y %H:%M', unit='s', error_is_null=True)
+    unique_timestamps = pc.strftime(unique_datetimes, format='%d-%m-%Y %H:%M')
+    record_datetime = unique_datetimes.take(timestamp_codes.indices)
+    glucose_str = pc.utf8_trim_whitespace(table[SCAN_GLUCOSE_COLUMN])
+    glucose_ok = pc.match_substring_regex(glucose_str, r'^[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$')
+    glucose = pc.cast(pc.if_else(glucose_ok, glucose_str, None), pa.float64())
+
+    # Skip empty rows; anything else that failed to parse is reported as malformed
+    malformed = pc.or_kleene(
+        pc.and_(pc.is_valid(timestamp_str), pc.is_null(record_datetime)),
+        pc.and_(pc.is_valid(glucose_str), pc.invert(glucose_ok)),
+    )
+    num_malformed = (pc.sum(pc.fill_null(malformed, False)).as_py() or 0) + num_short_rows
+    if num_malformed:
+        print(f"Warning: Skipping {num_malformed} malformed row(s).")
+
+    # Compare minutes since midnight against the filter times
+    start_filter = datetime.strptime(START_TIME_EXCLUSIVE, '%H:%M')
+    end_filter = datetime.strptime(END_TIME_INCLUSIVE, '%H:%M')
+    record_minutes = pc.add(pc.multiply(pc.hour(record_datetime), 60), pc.minute(record_datetime))
+
+    # Keep rows inside the time window that have a value in the Scan Glucose column
+    mask = pc.and_(
+        pc.and_(
+            pc.greater(record_minutes, start_filter.hour * 60 + start_filter.minute),
+            pc.less_equal(record_minutes, end_filter.hour * 60 + end_filter.minute),
+        ),
+        pc.is_valid(glucose),
+    )
+    processed_data = pa.table({
+        'datetime': pc.filter(record_datetime, mask, null_selection_behavior='drop'),
+        FINAL_COLUMNS[0]: pc.filter(timestamp_codes.indices, mask, null_selection_behavior='drop'),
+        FINAL_COLUMNS[1]: pc.filter(glucose, mask, null_selection_behavior='drop'),
+    })
+
     # --- 2. Sort the Processed Data ---
     print("Sorting the filtered data...")
-    processed_data.sort(key=lambda x: x[0])
+    processed_data = processed_data.take(pc.sort_indices(processed_data, sort_keys=[('datetime', 'ascending')]))
 
     # --- 3. Write the Final Report ---
     print(f"Writing final report to '{OUTPUT_FILENAME}'...")
     try:
-        with open(OUTPUT_FILENAME, mode='w', encoding='utf-8', newline='') as outfile:
-            writer = csv.writer(outfile)
-            writer.writerow(FINAL_COLUMNS) # Write the new header
-            
-            if not processed_data:
-                print("\nWarning: No records matched the specified time range and criteria.")
-            else:
-                for record_datetime, glucose_value in processed_data:
-                    timestamp_str = record_datetime.strftime('%d-%m-%Y %H:%M')
-                    writer.writerow([timestamp_str, glucose_value])
+        if processed_data.num_rows == 0:
+            print("\nWarning: No records matched the specified time range and criteria.")
+        # Glucose values are written with Python's float formatting (7 -> 7.0, 4.40 -> 4.4) like
+        # csv.writer did; Arrow's own float-to-string cast would write '7'. Only the few filtered
+        # rows are formatted here.
+        glucose_text = pa.array([repr(v) for v in processed_data[FINAL_COLUMNS[1]].to_pylist()], pa.string())
+        processed_data = processed_data.select(FINAL_COLUMNS).set_column(
+            0, FINAL_COLUMNS[0], unique_timestamps.take(processed_data[FINAL_COLUMNS[0]])
+        ).set_column(1, FINAL_COLUMNS[1], glucose_text)
+        pacsv.write_csv(
+            processed_data,
+            OUTPUT_FILENAME,
+            write_options=pacsv.WriteOptions(eol='\r\n', quoting_style='none', quoting_header='none'),
+        )
 
         print("-" * 30)
         print("Success! The data has been processed.")
-        print(f"{len(processed_data)} records were saved to the final report.")
+        print(f"{processed_data.num_rows} records were saved to the final report.")
         print(f"Output file: '{OUTPUT_FILENAME}'")
         print("-" * 30)
 
@@ -0,0 +1,98 @@
+# file: file_parts.py
+# Shared by split_file.py and reconstruct_file.py: the '.parts' container format and the byte-range copy.
+
+import errno
+import mmap
+import os
+import struct
+
+COPY_BUFFER_SIZE = 16 * 1024 * 1024 # Bytes per write when data passes through Python
+MAX_KERNEL_COPY = 1024 * 1024 * 1024 # Bytes requested per copy_file_range/sendfile call
+# errno values meaning "this kernel copy is not supported here", after which the next method is tried
+KERNEL_COPY_UNSUPPORTED = {
+    errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EBADF, errno.ENOTSOCK, errno.EOPNOTSUPP, errno.ENOTSUP
+}
+# Aggregated container written by `split_file --aggregate`: a header (magic, number of parts),
+# num_parts + 1 absolute u64 offsets where each part starts (the last one is the end of the data),
+# then the parts back to back. All fields are little-endian.
+CONTAINER_SUFFIX = ".parts"
+CONTAINER_MAGIC = b"PRTS"
+CONTAINER_HEADER = struct.Struct("<4sI")
+
+def copy_range(source_file, dest_file, offset: int, count: int) -> int:
+    """
+    Copies `count` bytes of `source_file`, starting at `offset`, to `dest_file` at its current position.
+
+    The copy is done inside the kernel when possible: os.copy_file_range first (which can
+    share extents on reflink filesystems), then os.sendfile, with an explicit source offset so
+    no data passes through Python and the source position does not matter. Whatever they do
+    not copy is written straight from a memory map of the source, or failing that copied
+    through a single reused buffer of at most COPY_BUFFER_SIZE. `dest_file` should be
+    unbuffered, so the kernel copies and the Python writes land at the same position.
+    Returns the number of bytes copied, which is less than `count` if the source ends early.
+    """
+    src_fd, dst_fd = source_file.fileno(), dest_file.fileno()
+    remaining = count
+
+    kernel_copies = []
+    if hasattr(os, "copy_file_range"):
+        kernel_copies.append(lambda off, size: os.copy_file_range(src_fd, dst_fd, size, off))
+    if hasattr(os, "sendfile"):
+        kernel_copies.append(lambda off, size: os.sendfile(dst_fd, src_fd, off, size))
+
+    for kernel_copy in kernel_copies:
+        try:
+            while remaining > 0:
+                copied = kernel_copy(offset, min(remaining, MAX_KERNEL_COPY))
+                if copied == 0:
+                    break # Some filesystems copy nothing instead of failing; let the next method try
+                offset += copied
+                remaining -= copied
+        except OSError as e:
+            if e.errno not in KERNEL_COPY_UNSUPPORTED:
+                raise
+        if remaining <= 0:
+            return count
+
+    if remaining <= 0 or copy_mapped(source_file, dest_file, offset, remaining):
+        return count
+
+    # Last resort: read into one reused buffer so no bytes object is allocated per chunk
+    source_file.seek(offset)
+    buffer = bytearray(min(remaining, COPY_BUFFER_SIZE))
+    view = memoryview(buffer)
+    while remaining > 0:
+        size = source_file.readinto(view[:min(remaining, len(buffer))])
+        if not size:
+            break # Source is shorter than expected
+        write_all(dest_file, view[:size])
+        remaining -= size
+    return count - remaining
+
+def write_all(dest_file, data):
+    """Writes all of `data` to an unbuffered file, whose writes may be partial."""
+    written = 0
+    while written < len(data):
+        written += dest_file.write(data[written:])
+
+def copy_mapped(source_file, dest_file, offset: int, count: int) -> bool:
+    """
+    Writes `count` bytes of `source_file` starting at `offset` from a read-only memory map.
+
+    The kernel copies straight from the mapped pages into `dest_file`, avoiding the extra
+    copy into a Python buffer. Returns False, having written nothing, if the range cannot be
+    mapped (e.g. the source is shorter than expected or not a regular file).
+    """
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY # Map offsets must be granularity-aligned
+    try:
+        mapped = mmap.mmap(source_file.fileno(), offset + count - start, access=mmap.ACCESS_READ, offset=start)
+    except (OSError, ValueError):
+        return False
+
+    with mapped:
+        if hasattr(mapped, "madvise"):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(mapped) as view:
+            for chunk_start in range(offset - start, offset - start + count, COPY_BUFFER_SIZE):
+                write_all(dest_file, view[chunk_start:min(chunk_start + COPY_BUFFER_SIZE, offset - start + count)])
+    return True
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+fNIRS Preprocessing and Feature Engineering
+
+Shared by the analysis scripts: converts raw fNIRS intensities to smoothed haemoglobin
+concentration changes, aligns them with CGM glucose readings and summarises them into
+per-epoch features. When numba is installed the heavy steps run as compiled kernels.
+"""
+
+import glob
+import os
+import hashlib
+import joblib
+import pandas as pd
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from verify_integrity import file_hexdigest
+
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pacsv
+    HAVE_PYARROW = True
+except ImportError:  # pyarrow is optional; fNIRS logs are then read with pandas
+    HAVE_PYARROW = False
+
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:  # numba is optional; preprocessing falls back to NumPy/pandas
+    HAVE_NUMBA = False
+    prange = range
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+# ==============================================================================
+# --- Preprocessing Configuration ---
+# ==============================================================================
+
+# Hash of this module's source, so any edit to the preprocessing code invalidates cached features
+with open(__file__, 'rb') as _source:
+    FEATURES_VERSION = hashlib.sha1(_source.read()).hexdigest()
+SMOOTHING_WINDOW = 30
+EPOCH_DURATION_S = 60
+EPOCH_OVERLAP_RATIO = 0.5
+CGM_TIMESTAMP_FORMAT = '%d-%m-%Y %H:%M' # 'Device Timestamp' format written by clean_cgm.py
+EPOCH_STATISTICS = ('mean', 'std', 'skew', 'kurtosis', 'max_minus_min') # Order produced by the feature kernels
+EPOCH_FEATURE_NAMES = list(EPOCH_STATISTICS) # Remove entries (e.g. 'skew', 'kurtosis') to drop those features
+USABLE_CHANNELS = [
+    (2,5,'short'),(3,6,'short'),(6,12,'short'),(7,13,'short'),(1,2,'long'),(1,6,'long'),(1,9,'long'),
+    (2,6,'long'),(2,7,'long'),(3,5,'long'),(3,7,'long'),(4,2,'long'),(4,5,'long'),(4,6,'long'),
+    (4,7,'long'),(5,6,'long'),(5,9,'long'),(5,12,'long'),(6,3,'long'),(6,5,'long'),(6,13,'long'),
+    (7,3,'long'),(7,9,'long'),(7,12,'long'),(8,2,'long'),(8,3,'long'),(8,11,'long'),(8,13,'long'),
+]
+DPF_WL1=6.25; DPF_WL2=4.89; D_SHORT_CM=0.8; D_LONG_CM=3.0; LN10=np.log(10)
+EXT_MOLAR_HBO_WL1=803.1/LN10; EXT_MOLAR_HHB_WL1=2278.1/LN10; EXT_MOLAR_HBO_WL2=1058.0/LN10; EXT_MOLAR_HHB_WL2=740.0/LN10
+EPS_HBO_WL1_uM=EXT_MOLAR_HBO_WL1/1.0e6; EPS_HHB_WL1_uM=EXT_MOLAR_HHB_WL1/1.0e6; EPS_HBO_WL2_uM=EXT_MOLAR_HBO_WL2/1.0e6; EPS_HHB_WL2_uM=EXT_MOLAR_HHB_WL2/1.0e6
+E_MATRIX_uM=np.array([[EPS_HBO_WL1_uM,EPS_HHB_WL1_uM],[EPS_HBO_WL2_uM,EPS_HHB_WL2_uM]])
+# fastmath without 'nnan'/'ninf', since the kernels rely on NaN checks for missing samples
+NUMBA_FASTMATH = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+try: E_INV_MATRIX_uM=np.linalg.inv(E_MATRIX_uM)
+except np.linalg.LinAlgError: print("FATAL ERROR: Extinction coefficient matrix is singular."); exit()
+
+# ==============================================================================
+# --- Preprocessing and Feature Engineering ---
+# ==============================================================================
+
+@njit(parallel=True, cache=True, fastmath=NUMBA_FASTMATH)
+def hb_conversion_kernel(raw, path_dpf, e_inv):
+    """
+    Beer-Lambert conversion for all channels.
+
+    Per channel this normalizes each wavelength by its NaN-ignoring mean, converts to optical
+    density and solves the 2x2 extinction system.
+
+    Args:
+        raw: Intensities of shape (n_channels, 2, n_samples) for the 740nm and 850nm wavelengths.
+        path_dpf: Array of shape (n_channels, 2) with source-detector distance x DPF per wavelength.
+        e_inv: Inverse of the 2x2 extinction coefficient matrix.
+
+    Returns:
+        float32 array of shape (n_samples, 2 * n_channels) holding HbO and HbR interleaved per channel.
+    """
+    n_channels, n_wavelengths, n_samples = raw.shape
+    hb = np.empty((n_samples, 2 * n_channels), dtype=np.float32)
+    for c in prange(n_channels):
+        od = np.empty((n_wavelengths, n_samples))
+        for k in range(n_wavelengths):
+            total, count = 0.0, 0
+            for t in range(n_samples):
+                if not np.isnan(raw[c, k, t]):
+                    total += raw[c, k, t]
+                    count += 1
+            baseline = total / count if count > 0 else np.nan
+            for t in range(n_samples):
+                ratio = raw[c, k, t] / baseline
+                if not np.isnan(ratio):
+                    ratio = max(ratio, 1e-9)
+                od[k, t] = -np.log10(ratio) / path_dpf[c, k]
+
+        for t in range(n_samples):
+            hb[t, 2 * c] = e_inv[0, 0] * od[0, t] + e_inv[0, 1] * od[1, t]
+            hb[t, 2 * c + 1] = e_inv[1, 0] * od[0, t] + e_inv[1, 1] * od[1, t]
+    return hb
+
+@njit(parallel=True, cache=True, fastmath=NUMBA_FASTMATH)
+def box_smooth(x, window):
+    """
+    Compiled equivalent of `centered_rolling_mean` for a 2D array, parallelized over columns.
+
+    Each column keeps a running sum and count of the non-NaN samples inside the window, so it
+    is smoothed in a single pass regardless of the window length.
+    """
+    n_samples, n_columns = x.shape
+    out = np.empty((n_samples, n_columns), dtype=x.dtype)
+    before, after = window // 2, (window - 1) // 2
+    for c in prange(n_columns):
+        total, count = 0.0, 0
+        for t in range(min(after, n_samples)):
+            if not np.isnan(x[t, c]):
+                total += x[t, c]
+                count += 1
+        for t in range(n_samples):
+            enter, leave = t + after, t - before - 1
+            if enter < n_samples and not np.isnan(x[enter, c]):
+                total += x[enter, c]
+                count += 1
+            if leave >= 0 and not np.isnan(x[leave, c]):
+                total -= x[leave, c]
+                count -= 1
+            out[t, c] = total / count if count > 0 else np.nan
+    return out
+
+@njit('float64[:, :, ::1](float32[:, ::1], int64, int64)', parallel=True, cache=True, fastmath=NUMBA_FASTMATH)
+def epoch_features_kernel(hb, samples_epoch, step):
+    """
+    Compiled equivalent of `compute_epoch_features` (returning all EPOCH_STATISTICS), parallelized over epochs.
+
+    Each epoch is scanned once, accumulating shifted power sums plus min/max per column, from
+    which mean/std/skew/kurtosis/ptp are derived. Shifting by the first valid sample of the
+    epoch keeps the power sums well conditioned.
+    """
+    n_samples, n_columns = hb.shape
+    n_epochs = (n_samples - samples_epoch) // step + 1 if n_samples >= samples_epoch else 0
+    out = np.empty((n_epochs, n_columns, 5))
+    for e in prange(n_epochs):
+        start = e * step
+        shift = np.full(n_columns, np.nan)
+        n = np.zeros(n_columns)
+        s1, s2, s3, s4 = np.zeros(n_columns), np.zeros(n_columns), np.zeros(n_columns), np.zeros(n_columns)
+        lo, hi = np.full(n_columns, np.inf), np.full(n_columns, -np.inf)
+        for t in range(start, start + samples_epoch):
+            for c in range(n_columns):
+                x = np.float64(hb[t, c])
+                if np.isnan(x):
+                    continue
+                if np.isnan(shift[c]):
+                    shift[c] = x
+                d = x - shift[c]
+                d2 = d * d
+                n[c] += 1
+                s1[c] += d
+                s2[c] += d2
+                s3[c] += d2 * d
+                s4[c] += d2 * d2
+                lo[c] = min(lo[c], x)
+                hi[c] = max(hi[c], x)
+        for c in range(n_columns):
+            k = n[c]
+            if k == 0:
+                out[e, c, :] = np.nan
+                continue
+            mu = s1[c] / k
+            m2 = max(s2[c] / k - mu * mu, 0.0)
+            m3 = s3[c] / k - 3 * mu * s2[c] / k + 2 * mu ** 3
+            m4 = s4[c] / k - 4 * mu * s3[c] / k + 6 * mu * mu * s2[c] / k - 3 * mu ** 4
+            out[e, c, 0] = shift[c] + mu
+            out[e, c, 1] = np.sqrt(m2 * k / (k - 1)) if k > 1 else np.nan
+            if k < 3:
+                out[e, c, 2] = np.nan
+            elif m2 == 0:
+                out[e, c, 2] = 0.0
+            else:
+                out[e, c, 2] = np.sqrt(k * (k - 1)) / (k - 2) * m3 / m2 ** 1.5
+            if k < 4:
+                out[e, c, 3] = np.nan
+            elif m2 == 0:
+                out[e, c, 3] = 0.0
+            else:
+                out[e, c, 3] = (k - 1) / ((k - 2) * (k - 3)) * ((k + 1) * m4 / (m2 * m2) - 3 * (k - 1))
+            out[e, c, 4] = hi[c] - lo[c]
+    return out
+
+def centered_rolling_mean(x, window):
+    """
+    Centered moving average along axis 0 in O(n), using prefix sums.
+
+    Matches pandas' `rolling(window, center=True, min_periods=1).mean()`: NaNs are ignored and
+    windows are truncated at the edges, yielding NaN only where a window has no valid sample.
+    """
+    valid = ~np.isnan(x)
+    pad = [(1, 0)] + [(0, 0)] * (x.ndim - 1)
+    sums = np.pad(np.cumsum(np.where(valid, x, 0), axis=0, dtype=np.float64), pad)
+    counts = np.pad(np.cumsum(valid, axis=0), pad)
+    t = np.arange(len(x))
+    lo = np.maximum(t - window // 2, 0)
+    hi = np.minimum(t + (window - 1) // 2 + 1, len(x))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums[hi] - sums[lo]) / (counts[hi] - counts[lo])
+
+def compute_epoch_features(hb, samples_epoch, step, feature_names=EPOCH_STATISTICS):
+    """
+    Computes per-epoch statistics for every column of `hb` in one vectorized pass.
+
+    Epochs are sliding windows of `samples_epoch` rows taken every `step` rows. NaNs are
+    ignored, and std/skew/kurtosis use the same bias-corrected estimators as pandas. The third
+    and fourth central moments are only computed when skew or kurtosis is requested.
+
+    Returns:
+        Array of shape (n_epochs, n_columns, len(feature_names)).
+    """
+    w = sliding_window_view(hb, samples_epoch, axis=0)[::step]  # (n_epochs, n_columns, samples_epoch)
+    valid = ~np.isnan(w)
+    n = valid.sum(axis=-1).astype(np.float64)
+    stats = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(valid, w, 0).sum(axis=-1, dtype=np.float64) / n
+        dev = np.where(valid, w - mean[..., None], 0)
+        dev2 = dev * dev
+        m2 = dev2.sum(axis=-1, dtype=np.float64) / n
+        stats['mean'] = mean
+        stats['std'] = np.sqrt(m2 * n / (n - 1))
+        if 'skew' in feature_names:
+            m3 = (dev2 * dev).sum(axis=-1, dtype=np.float64) / n
+            skew = np.sqrt(n * (n - 1)) / (n - 2) * m3 / m2 ** 1.5
+            stats['skew'] = np.where(n < 3, np.nan, np.where(m2 == 0, 0, skew))
+        if 'kurtosis' in feature_names:
+            m4 = (dev2 * dev2).sum(axis=-1, dtype=np.float64) / n
+            kurtosis = (n - 1) / ((n - 2) * (n - 3)) * ((n + 1) * m4 / (m2 * m2) - 3 * (n - 1))
+            stats['kurtosis'] = np.where(n < 4, np.nan, np.where(m2 == 0, 0, kurtosis))
+    ptp = np.where(valid, w, -np.inf).max(axis=-1) - np.where(valid, w, np.inf).min(axis=-1)
+    stats['max_minus_min'] = np.where(n > 0, ptp, np.nan)
+    return np.stack([stats[k] for k in feature_names], axis=-1)
+
+def load_fnirs(fnirs_path, columns):
+    """
+    Loads the `Time` column plus the requested channel `columns` of an fNIRS log.
+
+    Header names are whitespace-stripped and only the needed columns are parsed. Intensities are
+    read as float32 (the device's own precision), while `Time` stays float64 so the sampling rate
+    is unaffected. Requested columns missing from the file are skipped.
+    """
+    with open(fnirs_path, encoding='utf-8') as f:
+        header = f.readline().rstrip('\r\n').split(',')
+    wanted = {'Time', *columns}
+    dtypes = {name: (np.float64 if name.strip() == 'Time' else np.float32) for name in header if name.strip() in wanted}
+
+    if HAVE_PYARROW:
+        table = pacsv.read_csv(fnirs_path, convert_options=pacsv.ConvertOptions(
+            include_columns=list(dtypes),
+            column_types={name: pa.from_numpy_dtype(dtype) for name, dtype in dtypes.items()},
+        ))
+        df_fnirs = table.to_pandas()
+    else:
+        df_fnirs = pd.read_csv(fnirs_path, usecols=list(dtypes), dtype=dtypes)
+    df_fnirs.columns = df_fnirs.columns.str.strip()
+    return df_fnirs
+
+def preprocess_and_feature_engineer(fnirs_path, cgm_path, cgm_column):
+    """Loads, preprocesses, and engineers features from fNIRS and CGM data."""
+    channels = []
+    for s, d, ctype in USABLE_CHANNELS:
+        pmode, dval = ('LP', D_SHORT_CM) if ctype == 'short' else ('RP', D_LONG_CM)
+        cid, c740, c850 = f"S{s}_D{d}_{pmode}", f'S{s}_D{d}_740nm_{pmode}', f'S{s}_D{d}_850nm_{pmode}'
+        channels.append((cid, c740, c850, dval))
+
+    df_fnirs = load_fnirs(fnirs_path, [c for _, c740, c850, _ in channels for c in (c740, c850)])
+    channels = [ch for ch in channels if ch[1] in df_fnirs.columns and ch[2] in df_fnirs.columns]
+    df_cgm = pd.read_csv(cgm_path)
+    df_cgm.columns = df_cgm.columns.str.strip()
+    df_cgm['datetime'] = pd.to_datetime(df_cgm['Device Timestamp'], format=CGM_TIMESTAMP_FORMAT, cache=True, errors='coerce')
+    unparsed = df_cgm['datetime'].isna() & df_cgm['Device Timestamp'].notna()
+    if unparsed.any(): # Exports that deviate from the usual format go through the slower per-row parser
+        df_cgm.loc[unparsed, 'datetime'] = pd.to_datetime(df_cgm.loc[unparsed, 'Device Timestamp'], format='mixed', dayfirst=True)
+    df_cgm = df_cgm.sort_values(by='datetime').reset_index(drop=True)
+    first_cgm_time = df_cgm['datetime'].iloc[0]
+    df_cgm['Time_sec'] = (df_cgm['datetime'] - first_cgm_time).dt.total_seconds()
+    df_fnirs['glucose'] = np.interp(x=df_fnirs['Time'], xp=df_cgm['Time_sec'], fp=df_cgm[cgm_column])
+
+    hb_cols = [f'{cid}_{hb_type}_s' for cid, *_ in channels for hb_type in ('dHbO', 'dHbR')]
+    if HAVE_NUMBA and channels:
+        raw = np.stack([df_fnirs[[c740, c850]].to_numpy(dtype=np.float32).T for _, c740, c850, _ in channels])
+        path_dpf = np.array([(dval * DPF_WL1, dval * DPF_WL2) for *_, dval in channels])
+        hb = box_smooth(hb_conversion_kernel(raw, path_dpf, E_INV_MATRIX_uM), SMOOTHING_WINDOW)
+    else:
+        hb = np.empty((len(df_fnirs), len(hb_cols)))
+        for i, (_, c740, c850, dval) in enumerate(channels):
+            i740, i850 = df_fnirs[c740].to_numpy(dtype=np.float64), df_fnirs[c850].to_numpy(dtype=np.float64)
+            od740 = -np.log10(np.maximum(i740 / np.nanmean(i740), 1e-9))
+            od850 = -np.log10(np.maximum(i850 / np.nanmean(i850), 1e-9))
+            hb[:, 2 * i:2 * i + 2] = (E_INV_MATRIX_uM @ np.vstack((od740 / (dval * DPF_WL1), od850 / (dval * DPF_WL2)))).T
+        hb = centered_rolling_mean(hb, SMOOTHING_WINDOW).astype(np.float32)
+
+    sr = 1 / df_fnirs['Time'].diff().mean()
+    samples_epoch = int(EPOCH_DURATION_S * sr)
+    step = int(samples_epoch * (1 - EPOCH_OVERLAP_RATIO))
+
+    if HAVE_NUMBA:
+        features = epoch_features_kernel(hb, samples_epoch, step)
+        features = features[..., [EPOCH_STATISTICS.index(k) for k in EPOCH_FEATURE_NAMES]]
+    else:
+        features = compute_epoch_features(hb, samples_epoch, step, EPOCH_FEATURE_NAMES)
+    feature_names = [f'{col}_{k}' for col in hb_cols for k in EPOCH_FEATURE_NAMES]
+    X = pd.DataFrame(features.reshape(len(features), -1), columns=feature_names)
+    glucose_epochs = sliding_window_view(df_fnirs['glucose'].to_numpy(), samples_epoch)[::step]
+    y = np.nanmean(glucose_epochs, axis=-1)
+    X.dropna(axis=1, how='all', inplace=True)
+    X.fillna(X.mean(), inplace=True)
+    return X, y
+
+def file_fingerprint(path):
+    """Returns a file's size and SHA256, which (unlike its mtime) survive rewriting it with the same content."""
+    with open(path, 'rb') as f:
+        return os.fstat(f.fileno()).st_size, file_hexdigest(f)
+
+def load_or_preprocess(fnirs_path, cgm_path, cgm_column, cache_dir=None):
+    """
+    Returns preprocess_and_feature_engineer's (X, y), reusing a copy cached in `cache_dir`.
+
+    The cache key covers the content of both input files, the CGM column, every preprocessing
+    setting, this module's source and whether numba is used, so changing any of them triggers
+    a fresh computation. Each fNIRS file keeps a single cache entry: writing a new one removes
+    the entries from earlier keys. Caching is disabled when `cache_dir` is None.
+    """
+    if cache_dir is None:
+        return preprocess_and_feature_engineer(fnirs_path, cgm_path, cgm_column)
+
+    key_parts = (
+        FEATURES_VERSION, HAVE_NUMBA,
+        file_fingerprint(fnirs_path), file_fingerprint(cgm_path), cgm_column,
+        SMOOTHING_WINDOW, EPOCH_DURATION_S, EPOCH_OVERLAP_RATIO, CGM_TIMESTAMP_FORMAT,
+        tuple(USABLE_CHANNELS), tuple(EPOCH_FEATURE_NAMES),
+    )
+    key = hashlib.sha1(repr(key_parts).encode()).hexdigest()
+    cache_prefix = f"features_{os.path.splitext(os.path.basename(fnirs_path))[0]}_"
+    cache_path = os.path.join(cache_dir, f"{cache_prefix}{key}.joblib")
+
+    if os.path.exists(cache_path):
+        print(f"Loading cached features for '{os.path.basename(fnirs_path)}'")
+        return joblib.load(cache_path, mmap_mode='r')
+
+    X, y = preprocess_and_feature_engineer(fnirs_path, cgm_path, cgm_column)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{cache_path}.tmp"
+    joblib.dump((X, y), tmp_path, compress=0)
+    os.replace(tmp_path, cache_path)
+    stale_pattern = f"{glob.escape(cache_prefix)}{'?' * len(key)}.joblib"
+    for stale_path in glob.glob(os.path.join(glob.escape(cache_dir), stale_pattern)):
+        if stale_path != cache_path:
+            os.remove(stale_path)
+    return X, y
@@ -8,7 +8,13 @@ multiple machine learning experiments with hyperparameter tuning.
 """
 
 import os
+# The hyperparameter search parallelizes across CV fits, so keep BLAS/OpenMP inside each fit
+# single-threaded to avoid oversubscription. Must be set before the numeric libraries load.
+for _var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+    os.environ.setdefault(_var, '1')
+import hashlib
 import joblib
+import sklearn
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
@@ -18,12 +24,15 @@ import lightgbm as lgb
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.linear_model import Ridge, ElasticNet
 from sklearn.svm import SVR
-from sklearn.model_selection import GridSearchCV, train_test_split, TimeSeriesSplit, KFold
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401 (enables HalvingGridSearchCV)
+from sklearn.model_selection import GridSearchCV, HalvingGridSearchCV, train_test_split, TimeSeriesSplit, KFold
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler
 from sklearn.feature_selection import SelectKBest, f_regression
 from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score
 
+from fnirs_features import load_or_preprocess
+
 # ==============================================================================
 # --- Master Configuration ---
 # ==============================================================================
@@ -36,27 +45,16 @@ S2_FNIRS_PATH = os.path.join(BASE_DIR, 'second_fnirs_log.csv')
 S2_CGM_PATH = os.path.join(BASE_DIR, 'second_cgm_log.csv')
 S1_CGM_COLUMN = 'Scan Glucose (mmol/L)'
 S2_CGM_COLUMN = 'Scan Glucose (mmol/L)'
-
-# --- Preprocessing and Feature Engineering Constants ---
-SMOOTHING_WINDOW = 30
-EPOCH_DURATION_S = 60
-EPOCH_OVERLAP_RATIO = 0.5
-N_FEATURES_TO_SELECT = 40
-USABLE_CHANNELS = [
-    (2,5,'short'),(3,6,'short'),(6,12,'short'),(7,13,'short'),(1,2,'long'),(1,6,'long'),(1,9,'long'),
-    (2,6,'long'),(2,7,'long'),(3,5,'long'),(3,7,'long'),(4,2,'long'),(4,5,'long'),(4,6,'long'),
-    (4,7,'long'),(5,6,'long'),(5,9,'long'),(5,12,'long'),(6,3,'long'),(6,5,'long'),(6,13,'long'),
-    (7,3,'long'),(7,9,'long'),(7,12,'long'),(8,2,'long'),(8,3,'long'),(8,11,'long'),(8,13,'long'),
-]
-DPF_WL1=6.25; DPF_WL2=4.89; D_SHORT_CM=0.8; D_LONG_CM=3.0; LN10=np.log(10)
-EXT_MOLAR_HBO_WL1=803.1/LN10; EXT_MOLAR_HHB_WL1=2278.1/LN10; EXT_MOLAR_HBO_WL2=1058.0/LN10; EXT_MOLAR_HHB_WL2=740.0/LN10
-EPS_HBO_WL1_uM=EXT_MOLAR_HBO_WL1/1.0e6; EPS_HHB_WL1_uM=EXT_MOLAR_HHB_WL1/1.0e6; EPS_HBO_WL2_uM=EXT_MOLAR_HBO_WL2/1.0e6; EPS_HHB_WL2_uM=EXT_MOLAR_HHB_WL2/1.0e6
-E_MATRIX_uM=np.array([[EPS_HBO_WL1_uM,EPS_HHB_WL1_uM],[EPS_HBO_WL2_uM,EPS_HHB_WL2_uM]])
-try: E_INV_MATRIX_uM=np.linalg.inv(E_MATRIX_uM)
-except np.linalg.LinAlgError: print("FATAL ERROR: Extinction coefficient matrix is singular."); exit()
-
+CACHE_DIR = os.path.join(BASE_DIR, 'cache')
+USE_FEATURE_CACHE = True # Reuse preprocessed (X, y) from CACHE_DIR when inputs and settings are unchanged
+# Cache fitted scaler/selector steps so search candidates that only differ in regressor__* reuse them.
+# Off by default: on the bundled sessions hashing the inputs costs more than refitting these steps.
+CACHE_PIPELINE_TRANSFORMERS = False
+# Reuse each tuned best estimator from CACHE_DIR when its training data and search settings are unchanged
+USE_MODEL_CACHE = True
 
 # --- Model and Hyperparameter Tuning Configuration ---
+N_FEATURES_TO_SELECT = 40
 MODELS_AND_PARAMS = {
     'Ridge': {
         'model': Ridge(),
@@ -65,14 +63,14 @@ MODELS_AND_PARAMS = {
         }
     },
     'RandomForest': {
-        'model': RandomForestRegressor(random_state=42, n_jobs=-1),
+        'model': RandomForestRegressor(random_state=42, n_jobs=1),
         'params': {
             'regressor__n_estimators': [50, 100, 200],
             'regressor__max_depth': [None, 10, 20],
         }
     },
     'XGBoost': {
-        'model': xgb.XGBRegressor(objective='reg:squarederror', random_state=42, n_jobs=-1),
+        'model': xgb.XGBRegressor(objective='reg:squarederror', random_state=42, n_jobs=1),
         'params': {
             'regressor__n_estimators': [100, 200],
             'regressor__learning_rate': [0.01, 0.1],
@@ -94,7 +92,7 @@ MODELS_AND_PARAMS = {
         }
     },
     'LightGBM': {
-        'model': lgb.LGBMRegressor(random_state=42, n_jobs=-1),
+        'model': lgb.LGBMRegressor(random_state=42, n_jobs=1),
         'params': {
             'regressor__n_estimators': [100, 200],
             'regressor__learning_rate': [0.01, 0.1],
@@ -107,9 +105,14 @@ MODELS_AND_PARAMS = {
 CV_STRATEGY = 'TimeSeriesSplit'  # Options: 'TimeSeriesSplit', 'BlockedKFold', 'KFold'
 N_CV_SPLITS = 5
 CV_GAP_EPOCHS = 2 # Only used for BlockedKFold
+SEARCH_STRATEGY = 'GridSearchCV'  # Options: 'GridSearchCV', 'HalvingGridSearchCV'
+HALVING_FACTOR = 3 # Only used for HalvingGridSearchCV (and only when the data allows two or more rounds)
+HALVING_MIN_TEST_SAMPLES = 5 # Smallest CV test fold allowed on the first halving iteration
 RUN_GENERALIZATION_EXPERIMENTS = True
 RUN_COMBINED_HOLDOUT_EXPERIMENT = True
 TRAIN_SPLIT_RATIO = 0.7 # For combined holdout experiment
+CLARKE_MAX_PLOT_POINTS = 50000 # Larger Clarke Error Grids plot a random sample of CLARKE_PLOT_SAMPLE_SIZE points
+CLARKE_PLOT_SAMPLE_SIZE = 5000
 
 # ==============================================================================
 # --- Helper Classes and Functions ---
@@ -137,94 +140,116 @@ def get_cv_strategy(strategy_name, n_splits, gap):
     else: # Default to KFold
         return KFold(n_splits=n_splits, shuffle=False)
 
+def get_search_strategy(strategy_name, pipeline, param_grid, cv_strategy, n_samples):
+    # Successive halving scores every candidate on a subsample first and only keeps the best
+    # 1/HALVING_FACTOR for the next, larger subsample. The first subsample must still leave
+    # enough samples in each CV test fold for R² to be defined.
+    min_resources = (cv_strategy.get_n_splits() + 1) * HALVING_MIN_TEST_SAMPLES
+    # With fewer samples than that only one round runs: every candidate would be scored once on
+    # a subsample and nothing eliminated, so the exhaustive search is used instead.
+    if strategy_name == 'HalvingGridSearchCV' and n_samples >= min_resources * HALVING_FACTOR:
+        return HalvingGridSearchCV(
+            pipeline, param_grid, cv=cv_strategy, n_jobs=-1, scoring='r2',
+            factor=HALVING_FACTOR, resource='n_samples', min_resources=min_resources, random_state=42
+        )
+    else: # Default to an exhaustive GridSearchCV
+        return GridSearchCV(pipeline, param_grid, cv=cv_strategy, n_jobs=-1, scoring='r2')
+
+def get_pipeline_memory():
+    if not CACHE_PIPELINE_TRANSFORMERS:
+        return None
+    return joblib.Memory(location=os.path.join(CACHE_DIR, 'pipeline'), verbose=0)
+
+def fit_or_load_best_model(experiment_name, model_name, pipeline, param_grid, cv_strategy, X_train, y_train):
+    """
+    Runs the hyperparameter search and returns (best_estimator, best_params).
+
+    With USE_MODEL_CACHE the result is stored in CACHE_DIR, keyed by the experiment, the model,
+    a hash of the training data, the search settings and the model library versions, so re-runs
+    skip tuning entirely.
+    """
+    if USE_MODEL_CACHE:
+        data_hash = hashlib.sha1(pd.util.hash_pandas_object(X_train).values.tobytes())
+        data_hash.update(np.ascontiguousarray(y_train).tobytes())
+        settings = (
+            pipeline, param_grid, SEARCH_STRATEGY, HALVING_FACTOR, HALVING_MIN_TEST_SAMPLES,
+            CV_STRATEGY, N_CV_SPLITS, CV_GAP_EPOCHS, tuple(X_train.columns),
+            # Pickled estimators are tied to the library versions that produced them
+            sklearn.__version__, xgb.__version__, lgb.__version__,
+        )
+        data_hash.update(joblib.hash(settings).encode())
+        cache_path = os.path.join(CACHE_DIR, f"{experiment_name}_{model_name}_{data_hash.hexdigest()}.joblib")
+        if os.path.exists(cache_path):
+            print(f"Loading cached {model_name} model for {experiment_name}")
+            return joblib.load(cache_path)
+
+    grid_search = get_search_strategy(SEARCH_STRATEGY, pipeline, param_grid, cv_strategy, len(X_train))
+    grid_search.fit(X_train, y_train)
+    result = (grid_search.best_estimator_, grid_search.best_params_)
+
+    if USE_MODEL_CACHE:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.tmp"
+        joblib.dump(result, tmp_path)
+        os.replace(tmp_path, cache_path)
+    return result
+
+_CLARKE_PLOT = None # (fig, ax, scatter), created on first use and reused by every plot_clarke_error_grid call
+
+def _get_clarke_plot():
+    """Returns the shared Clarke Error Grid figure, drawing the axes and zone guide lines once."""
+    global _CLARKE_PLOT
+    if _CLARKE_PLOT is None:
+        fig, ax = plt.subplots(figsize=(10, 10))
+        scatter = ax.scatter([], [], c='k', s=25, zorder=2, rasterized=True)
+        ax.set_xlabel("Reference Glucose (mg/dL)", fontsize=14)
+        ax.set_ylabel("Predicted Glucose (mg/dL)", fontsize=14)
+        ax.set_xticks(range(0, 401, 50))
+        ax.set_yticks(range(0, 401, 50))
+        ax.set_xlim(0, 400)
+        ax.set_ylim(0, 400)
+        ax.set_facecolor('whitesmoke')
+        ax.grid(True, linestyle='--', color='lightgray')
+        ax.set_aspect('equal', adjustable='box')
+        x = np.arange(0, 401)
+        ax.plot(x, x, 'k-', lw=1.5, zorder=1)
+        ax.plot([0, 400], [70, 70], 'k--')
+        ax.plot([70, 70], [0, 400], 'k--')
+        ax.plot([0, 400], [180, 180], 'k--')
+        ax.plot([180, 180], [0, 400], 'k--')
+        _CLARKE_PLOT = (fig, ax, scatter)
+    return _CLARKE_PLOT
+
 def plot_clarke_error_grid(y_true_mmol, y_pred_mmol, title, plots_folder):
     """Generates and saves a Clarke Error Grid plot."""
     y_true = np.array(y_true_mmol) * 18.0182
     y_pred = np.array(y_pred_mmol) * 18.0182
-    fig, ax = plt.subplots(figsize=(10, 10))
-    ax.scatter(y_true, y_pred, c='k', s=25, zorder=2)
-    ax.set_xlabel("Reference Glucose (mg/dL)", fontsize=14)
-    ax.set_ylabel("Predicted Glucose (mg/dL)", fontsize=14)
+    fig, ax, scatter = _get_clarke_plot()
+    if len(y_true) > CLARKE_MAX_PLOT_POINTS:
+        # Zone counts below use every point; only the scatter is thinned out
+        idx = np.random.default_rng(42).choice(len(y_true), CLARKE_PLOT_SAMPLE_SIZE, replace=False)
+        scatter.set_offsets(np.column_stack((y_true[idx], y_pred[idx])))
+    else:
+        scatter.set_offsets(np.column_stack((y_true, y_pred)))
     ax.set_title(title, fontsize=16)
-    ax.set_xticks(range(0, 401, 50))
-    ax.set_yticks(range(0, 401, 50))
-    ax.set_xlim(0, 400)
-    ax.set_ylim(0, 400)
-    ax.set_facecolor('whitesmoke')
-    ax.grid(True, linestyle='--', color='lightgray')
-    ax.set_aspect('equal', adjustable='box')
-    x = np.arange(0, 401)
-    ax.plot(x, x, 'k-', lw=1.5, zorder=1)
-    ax.plot([0, 400], [70, 70], 'k--')
-    ax.plot([70, 70], [0, 400], 'k--')
-    ax.plot([0, 400], [180, 180], 'k--')
-    ax.plot([180, 180], [0, 400], 'k--')
     
-    zone_counts = {'A': 0, 'B': 0, 'C': 0, 'D': 0, 'E': 0}
     total_points = len(y_true)
-    for true, pred in zip(y_true, y_pred):
-        if (abs(true - pred) / true < 0.2) or (true < 70 and pred < 70):
-            zone_counts['A'] += 1
-        elif (true >= 70 and pred <= 50) or (true <= 70 and pred >= 180):
-            zone_counts['D'] += 1
-        elif (true > 180 and pred < 70) or (true < 70 and pred > 180):
-            zone_counts['E'] += 1
-        else:
-            zone_counts['B'] += 1
-            
+    with np.errstate(divide='ignore', invalid='ignore'):
+        zone_a = (np.abs(y_true - y_pred) / y_true < 0.2) | ((y_true < 70) & (y_pred < 70))
+    zone_d = ~zone_a & (((y_true >= 70) & (y_pred <= 50)) | ((y_true <= 70) & (y_pred >= 180)))
+    zone_e = ~zone_a & ~zone_d & (((y_true > 180) & (y_pred < 70)) | ((y_true < 70) & (y_pred > 180)))
+    zone_b = ~(zone_a | zone_d | zone_e)
+    zone_counts = {'A': int(zone_a.sum()), 'B': int(zone_b.sum()), 'C': 0, 'D': int(zone_d.sum()), 'E': int(zone_e.sum())}
+
     print("\n--- Clarke Error Grid Analysis ---")
     if total_points > 0:
         for z, c in zone_counts.items():
             print(f"  Zone {z}: {c}/{total_points} ({(c/total_points)*100:.2f}%)")
             
-    plt.savefig(os.path.join(plots_folder, f"ClarkeGrid_{title.replace(' ', '_').replace(':', '')}.png"), dpi=150)
-    plt.close(fig)
-
-def preprocess_and_feature_engineer(fnirs_path, cgm_path, cgm_column):
-    """Loads, preprocesses, and engineers features from fNIRS and CGM data."""
-    df_fnirs = pd.read_csv(fnirs_path)
-    df_fnirs.columns = df_fnirs.columns.str.strip()
-    df_cgm = pd.read_csv(cgm_path)
-    df_cgm.columns = df_cgm.columns.str.strip()
-    df_cgm['datetime'] = pd.to_datetime(df_cgm['Device Timestamp'], dayfirst=True)
-    df_cgm = df_cgm.sort_values(by='datetime').reset_index(drop=True)
-    first_cgm_time = df_cgm['datetime'].iloc[0]
-    df_cgm['Time_sec'] = (df_cgm['datetime'] - first_cgm_time).dt.total_seconds()
-    df_fnirs['glucose'] = np.interp(x=df_fnirs['Time'], xp=df_cgm['Time_sec'], fp=df_cgm[cgm_column])
-    
-    for s, d, ctype in USABLE_CHANNELS:
-        pmode, dval = ('LP', D_SHORT_CM) if ctype == 'short' else ('RP', D_LONG_CM)
-        cid, c740, c850 = f"S{s}_D{d}_{pmode}", f'S{s}_D{d}_740nm_{pmode}', f'S{s}_D{d}_850nm_{pmode}'
-        if c740 not in df_fnirs.columns or c850 not in df_fnirs.columns:
-            continue
-        od740 = -np.log10(np.maximum(df_fnirs[c740] / np.nanmean(df_fnirs[c740]), 1e-9))
-        od850 = -np.log10(np.maximum(df_fnirs[c850] / np.nanmean(df_fnirs[c850]), 1e-9))
-        hbo, hbr = (E_INV_MATRIX_uM @ np.vstack((od740 / (dval * DPF_WL1), od850 / (dval * DPF_WL2))))
-        df_fnirs[f'{cid}_dHbO_s'] = pd.Series(hbo).rolling(SMOOTHING_WINDOW, center=True, min_periods=1).mean()
-        df_fnirs[f'{cid}_dHbR_s'] = pd.Series(hbr).rolling(SMOOTHING_WINDOW, center=True, min_periods=1).mean()
-        
-    hb_cols = [c for c in df_fnirs.columns if '_dHb' in c and '_s' in c]
-    sr = 1 / df_fnirs['Time'].diff().mean()
-    samples_epoch = int(EPOCH_DURATION_S * sr)
-    step = int(samples_epoch * (1 - EPOCH_OVERLAP_RATIO))
-    epochs, labels = [], []
-    
-    for i in range(0, len(df_fnirs) - samples_epoch + 1, step):
-        epoch_df = df_fnirs.iloc[i:i + samples_epoch]
-        features = {}
-        for col in hb_cols:
-            s = epoch_df[col].dropna()
-            f = {'mean': s.mean(), 'std': s.std(), 'skew': s.skew(), 'kurtosis': s.kurtosis(), 'max_minus_min': s.max() - s.min()}
-            for k, v in f.items():
-                features[f'{col}_{k}'] = v
-        epochs.append(features)
-        labels.append(epoch_df['glucose'].mean())
-        
-    X = pd.DataFrame(epochs)
-    y = np.array(labels)
-    X.dropna(axis=1, how='all', inplace=True)
-    X.fillna(X.mean(), inplace=True)
-    return X, y
+    fig.savefig(
+        os.path.join(plots_folder, f"ClarkeGrid_{title.replace(' ', '_').replace(':', '')}.png"),
+        dpi=150, bbox_inches='tight'
+    )
 
 def evaluate_model(y_true, y_pred, model_name, experiment_name, plots_folder):
     """Calculates and prints performance metrics and generates plots."""
@@ -256,6 +281,7 @@ def run_generalization_experiment(train_data, test_data, experiment_name, cv_str
     print(f"Training data shape: {X_train.shape}")
     print(f"Test data shape:     {X_test.shape}")
     print(f"CV Strategy: {CV_STRATEGY}")
+    print(f"Search Strategy: {SEARCH_STRATEGY}")
     print("=" * 70)
 
     plots_folder = os.path.join(BASE_DIR, f"PLOTS_{experiment_name}")
@@ -267,13 +293,13 @@ def run_generalization_experiment(train_data, test_data, experiment_name, cv_str
             ('scaler', StandardScaler()),
             ('selector', SelectKBest(f_regression, k=min(N_FEATURES_TO_SELECT, X_train.shape[1]))),
             ('regressor', config['model'])
-        ])
+        ], memory=get_pipeline_memory())
 
-        grid_search = GridSearchCV(pipeline, config['params'], cv=cv_strategy, n_jobs=-1, scoring='r2')
-        grid_search.fit(X_train, y_train)
+        best_model, best_params = fit_or_load_best_model(
+            experiment_name, name, pipeline, config['params'], cv_strategy, X_train, y_train
+        )
 
-        print(f"Best parameters for {name}: {grid_search.best_params_}")
-        best_model = grid_search.best_estimator_
+        print(f"Best parameters for {name}: {best_params}")
 
         y_pred = best_model.predict(X_test)
         evaluate_model(y_test, y_pred, name, experiment_name, plots_folder)
@@ -289,6 +315,7 @@ def run_combined_holdout_experiment(s1_data, s2_data, cv_strategy):
     print("=" * 70)
     print(f"--- Running {experiment_name} Experiment ---")
     print(f"CV Strategy: {CV_STRATEGY}")
+    print(f"Search Strategy: {SEARCH_STRATEGY}")
     print("=" * 70)
 
     plots_folder = os.path.join(BASE_DIR, f"PLOTS_{experiment_name}")
@@ -310,13 +337,13 @@ def run_combined_holdout_experiment(s1_data, s2_data, cv_strategy):
             ('scaler', StandardScaler()),
             ('selector', SelectKBest(f_regression, k=min(N_FEATURES_TO_SELECT, X_train_combined.shape[1]))),
             ('regressor', config['model'])
-        ])
+        ], memory=get_pipeline_memory())
 
-        grid_search = GridSearchCV(pipeline, config['params'], cv=cv_strategy, n_jobs=-1, scoring='r2')
-        grid_search.fit(X_train_combined, y_train_combined)
+        best_model, best_params = fit_or_load_best_model(
+            experiment_name, name, pipeline, config['params'], cv_strategy, X_train_combined, y_train_combined
+        )
 
-        print(f"Best parameters for {name}: {grid_search.best_params_}")
-        best_model = grid_search.best_estimator_
+        print(f"Best parameters for {name}: {best_params}")
 
         # Evaluate on Session 1 holdout
         y_s1_pred = best_model.predict(X_s1_test)
@@ -332,8 +359,9 @@ def run_combined_holdout_experiment(s1_data, s2_data, cv_strategy):
 
 if __name__ == "__main__":
     print("--- Starting Data Preprocessing ---")
-    s1_data = preprocess_and_feature_engineer(S1_FNIRS_PATH, S1_CGM_PATH, S1_CGM_COLUMN)
-    s2_data = preprocess_and_feature_engineer(S2_FNIRS_PATH, S2_CGM_PATH, S2_CGM_COLUMN)
+    cache_dir = CACHE_DIR if USE_FEATURE_CACHE else None
+    s1_data = load_or_preprocess(S1_FNIRS_PATH, S1_CGM_PATH, S1_CGM_COLUMN, cache_dir=cache_dir)
+    s2_data = load_or_preprocess(S2_FNIRS_PATH, S2_CGM_PATH, S2_CGM_COLUMN, cache_dir=cache_dir)
     print("--- Data Preprocessing Complete ---")
 
     cv_strategy = get_cv_strategy(CV_STRATEGY, N_CV_SPLITS, CV_GAP_EPOCHS)
@@ -1,9 +1,88 @@
 # file: reconstruct_file.py
 
 import argparse
+import os
 import re
+import struct
 from pathlib import Path
 
+from file_parts import CONTAINER_HEADER, CONTAINER_MAGIC, CONTAINER_SUFFIX, copy_range
+
+# Extracts info from a part filename like 'myfile_part1_of_2.csv'. The base name is lazy and the
+# extension is a single optional '.ext', so pathological names cannot cause heavy backtracking.
+PART_RE = re.compile(r"(.+?)_part(\d+)_of_(\d+)(\.[^.]*)?$")
+
+def append_file(source_file, dest_file, offset: int, count: int):
+    """
+    Appends `count` bytes of `source_file`, starting at `offset`, to `dest_file` (see copy_range).
+
+    Raises:
+        IOError: If the source ends before `count` bytes were copied.
+    """
+    copied = copy_range(source_file, dest_file, offset, count)
+    if copied != count:
+        raise IOError(f"Only {copied} of {count} bytes could be read from '{source_file.name}'")
+
+def read_container_index(container_file) -> list[int]:
+    """
+    Reads the header of an aggregated container and returns its part offsets.
+
+    Raises:
+        ValueError: If the header is malformed or the container is truncated.
+    """
+    header = container_file.read(CONTAINER_HEADER.size)
+    if len(header) != CONTAINER_HEADER.size:
+        raise ValueError("Error: Container is too short to hold a header.")
+    magic, num_parts = CONTAINER_HEADER.unpack(header)
+    if magic != CONTAINER_MAGIC:
+        raise ValueError("Error: Not a parts container (bad magic).")
+
+    # Check the count against the file size before it sizes any read, so a corrupt header cannot exhaust memory
+    data_start = CONTAINER_HEADER.size + 8 * (num_parts + 1)
+    container_size = os.fstat(container_file.fileno()).st_size
+    if data_start > container_size:
+        raise ValueError("Error: Container header is truncated or its part count is corrupt.")
+
+    offsets_format = struct.Struct(f"<{num_parts + 1}Q")
+    raw_offsets = container_file.read(offsets_format.size)
+    if len(raw_offsets) != offsets_format.size:
+        raise ValueError("Error: Container header is truncated.")
+    offsets = list(offsets_format.unpack(raw_offsets))
+
+    if offsets[0] != data_start or offsets != sorted(offsets) or offsets[-1] != container_size:
+        raise ValueError("Error: Container offsets do not match its size (truncated or corrupt).")
+    return offsets
+
+def reconstruct_container(container_path: Path):
+    """
+    Reconstructs a file from an aggregated '{original_name}{original_ext}.parts' container.
+
+    Raises:
+        FileNotFoundError: If the container does not exist.
+        ValueError: If the container header is malformed or the file is truncated.
+    """
+    if not container_path.is_file():
+        raise FileNotFoundError(f"Error: Container file not found at '{container_path}'")
+
+    original_path = container_path.with_suffix("")
+    output_path = container_path.with_name(f"{original_path.stem}_reconstructed{original_path.suffix}")
+
+    with open(container_path, "rb", buffering=0) as container_file:
+        offsets = read_container_index(container_file)
+        print(f"Reconstructing '{output_path.name}' from {len(offsets) - 1} parts in '{container_path.name}'...")
+
+        try:
+            # The parts are stored contiguously, so the whole payload is a single copy
+            with open(output_path, "wb", buffering=0) as dest_file:
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(container_file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                append_file(container_file, dest_file, offsets[0], offsets[-1] - offsets[0])
+
+            print(f"\nReconstruction complete. File saved as '{output_path.name}'")
+
+        except IOError as e:
+            print(f"An I/O error occurred: {e}")
+
 def reconstruct_file(first_part_path: Path):
     """
     Reconstructs a single file from its split parts.
@@ -12,19 +91,23 @@ def reconstruct_file(first_part_path: Path):
     based on the naming convention:
     {original_name}_part{part_num}_of_{total_parts}{original_ext}
 
+    Aggregated '.parts' containers (see `split_file --aggregate`) are
+    handed to `reconstruct_container`.
+
     Args:
-        first_part_path: The path to any one of the file parts.
+        first_part_path: The path to any one of the file parts, or to a container.
     
     Raises:
         FileNotFoundError: If any of the required parts are missing.
         ValueError: If the filename format is incorrect.
     """
+    if first_part_path.suffix == CONTAINER_SUFFIX:
+        return reconstruct_container(first_part_path)
+
     if not first_part_path.is_file():
         raise FileNotFoundError(f"Error: Part file not found at '{first_part_path}'")
 
-    # Regex to extract info from filename like 'myfile_part1_of_2.csv'
-    pattern = re.compile(r"(.+)_part(\d+)_of_(\d+)(.*)")
-    match = pattern.match(first_part_path.name)
+    match = PART_RE.fullmatch(first_part_path.name)
 
     if not match:
         raise ValueError(
@@ -32,7 +115,7 @@ def reconstruct_file(first_part_path: Path):
             "Expected: 'original_name_partX_of_Y.ext'"
         )
 
-    base_name, _, total_parts_str, ext = match.groups()
+    base_name, _, total_parts_str, ext = match.groups(default="")
     total_parts = int(total_parts_str)
     
     # Determine the original, reconstructed filename
@@ -52,11 +135,14 @@ def reconstruct_file(first_part_path: Path):
         part_paths.append(part_path)
 
     try:
-        with open(output_path, "wb") as dest_file:
+        # Unbuffered destination: append_file writes to the fd directly or in COPY_BUFFER_SIZE chunks
+        with open(output_path, "wb", buffering=0) as dest_file:
             for part_path in part_paths:
                 print(f"  -> Appending '{part_path.name}'...")
                 with open(part_path, "rb") as source_part:
-                    dest_file.write(source_part.read())
+                    if hasattr(os, "posix_fadvise"):
+                        os.posix_fadvise(source_part.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                    append_file(source_part, dest_file, 0, os.fstat(source_part.fileno()).st_size)
         
         print(f"\nReconstruction complete. File saved as '{output_path.name}'")
 
@@ -70,7 +156,7 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "part_file",
-        help="The path to any one of the file parts (e.g., the first part)."
+        help="The path to any one of the file parts (e.g., the first part), or to a '.parts' container."
     )
     
     args = parser.parse_args()
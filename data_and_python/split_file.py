@@ -2,51 +2,138 @@
 
 import argparse
 import math
+import stat
+import struct
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-def split_file(file_path: Path, num_parts: int):
+from file_parts import CONTAINER_HEADER, CONTAINER_MAGIC, CONTAINER_SUFFIX, copy_range
+
+MAX_PARTS_IN_FLIGHT = 16 # Default cap on parts copied concurrently; much larger batches mostly add latency
+
+def preallocate(file_obj, size: int):
+    """Reserves `size` bytes for a new file up front so the filesystem allocates its extents once."""
+    if size <= 0 or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(file_obj.fileno(), 0, size)
+    except OSError:
+        pass # Not supported by this filesystem; the file simply grows as it is written
+
+def write_range(source_file, dest_file, offset: int, count: int, dest_base: int):
+    """
+    Copies `count` bytes of `source_file`, starting at `offset`, into a new file after its first `dest_base` bytes.
+
+    The destination is preallocated to its final size, and the source range is read sequentially
+    and then dropped from the page cache, since it is not read again. If the source turns out to be
+    shorter, the destination is cut back to what was written, so the preallocated zero tail cannot
+    pass for data, and IOError is raised.
+    """
+    preallocate(dest_file, dest_base + count)
+    has_fadvise = hasattr(os, "posix_fadvise") and count > 0
+    if has_fadvise:
+        os.posix_fadvise(source_file.fileno(), offset, count, os.POSIX_FADV_SEQUENTIAL)
+    copied = copy_range(source_file, dest_file, offset, count)
+    if has_fadvise:
+        os.posix_fadvise(source_file.fileno(), offset, count, os.POSIX_FADV_DONTNEED)
+    if copied != count:
+        dest_file.truncate(dest_base + copied)
+        raise IOError(f"Only {copied} of {count} bytes were copied to '{dest_file.name}'; the source changed size")
+
+def write_part(file_path: Path, part_path: Path, offset: int, count: int):
+    """Writes `count` bytes of `file_path`, starting at `offset`, to a new file at `part_path`."""
+    # Each part uses its own source handle, so concurrent copies never share a file position
+    with open(file_path, "rb") as source_file, open(part_path, "wb", buffering=0) as part_file:
+        write_range(source_file, part_file, offset, count, 0)
+
+def write_container(file_path: Path, container_path: Path, total_size: int, part_size: int, num_parts: int):
+    """Writes all parts of `file_path` into one container: an offset index header followed by the parts."""
+    data_start = CONTAINER_HEADER.size + 8 * (num_parts + 1)
+    offsets = [data_start + min(i * part_size, total_size) for i in range(num_parts + 1)]
+    with open(file_path, "rb") as source_file, open(container_path, "wb", buffering=0) as container_file:
+        container_file.write(CONTAINER_HEADER.pack(CONTAINER_MAGIC, num_parts))
+        container_file.write(struct.pack(f"<{num_parts + 1}Q", *offsets))
+        write_range(source_file, container_file, 0, total_size, data_start)
+
+def split_file(
+    file_path: Path, num_parts: int, aggregate: bool = False, workers: int | None = None, verbose: bool = False
+):
     """
     Splits a single file into a specified number of parts.
 
     The output files will be named using the pattern:
     {original_name}_part{part_num}_of_{total_parts}{original_ext}
 
+    With `aggregate`, the parts are instead written back to back into a single
+    '{original_name}{original_ext}.parts' container with an offset index header,
+    which avoids creating num_parts separate files.
+
     Args:
         file_path: The path to the file to be split.
         num_parts: The number of smaller files to create.
+        aggregate: Write one container file instead of separate part files.
+        workers: How many parts to copy concurrently. Defaults to
+            min(num_parts, MAX_PARTS_IN_FLIGHT); the copies are I/O-bound, so
+            this is not tied to the CPU count.
+        verbose: Also list the created part files once the split is done.
     
     Raises:
         FileNotFoundError: If the input file does not exist.
-        ValueError: If num_parts is not a positive integer.
+        ValueError: If num_parts or workers is not a positive integer.
     """
-    if not file_path.is_file():
+    # One stat serves both the existence check and the size
+    try:
+        source_stat = file_path.stat()
+    except FileNotFoundError:
+        source_stat = None
+    if source_stat is None or not stat.S_ISREG(source_stat.st_mode):
         raise FileNotFoundError(f"Error: Source file not found at '{file_path}'")
     
     if not isinstance(num_parts, int) or num_parts <= 0:
         raise ValueError("Error: Number of parts must be a positive integer.")
 
-    total_size = file_path.stat().st_size
+    if workers is None:
+        workers = min(num_parts, MAX_PARTS_IN_FLIGHT)
+    elif not isinstance(workers, int) or workers <= 0:
+        raise ValueError("Error: Number of workers must be a positive integer.")
+
+    total_size = source_stat.st_size
     part_size = math.ceil(total_size / num_parts)
 
     print(f"Splitting '{file_path.name}' ({total_size} bytes) into {num_parts} parts of ~{part_size} bytes each.")
 
+    if aggregate:
+        container_path = file_path.with_name(file_path.name + CONTAINER_SUFFIX)
+        print(f"  -> Creating '{container_path.name}'...")
+        try:
+            write_container(file_path, container_path, total_size, part_size, num_parts)
+            print("\nSplit complete.")
+        except IOError as e:
+            print(f"An I/O error occurred: {e}")
+        return
+
+    # Construct the output filenames up front so the submission loop below only schedules I/O
+    part_paths = [
+        file_path.with_name(f"{file_path.stem}_part{part_num}_of_{num_parts}{file_path.suffix}")
+        for part_num in range(1, num_parts + 1)
+    ]
+
     try:
-        with open(file_path, "rb") as source_file:
-            for i in range(num_parts):
-                part_num = i + 1
-                
-                # Construct the output filename
-                part_filename = f"{file_path.stem}_part{part_num}_of_{num_parts}{file_path.suffix}"
-                part_path = file_path.with_name(part_filename)
-                
-                print(f"  -> Creating '{part_path.name}'...")
-                
-                with open(part_path, "wb") as part_file:
-                    content = source_file.read(part_size)
-                    if not content:
-                        break # Stop if there's no more content to read
-                    part_file.write(content)
+        # Parts are independent, so several are copied at once to keep the storage queue busy
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = []
+            for i, part_path in enumerate(part_paths):
+                # Parts past the end of a small file are still created (empty) so reconstruction finds them all
+                offset = i * part_size
+                count = max(0, min(part_size, total_size - offset))
+                pending.append(pool.submit(write_part, file_path, part_path, offset, count))
 
+            for future in pending:
+                future.result() # Re-raises the first I/O error from the workers
+
+        if verbose:
+            print("\n".join(f"  -> Created '{part_path.name}'" for part_path in part_paths))
         print("\nSplit complete.")
     except IOError as e:
         print(f"An I/O error occurred: {e}")
@@ -64,11 +151,27 @@ if __name__ == "__main__":
         default=2,
         help="The number of parts to split the file into (default: 2)."
     )
+    parser.add_argument(
+        "--aggregate",
+        action="store_true",
+        help="Write all parts into a single '<file>.parts' container instead of separate files."
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        default=None,
+        help=f"How many parts to write concurrently (default: up to {MAX_PARTS_IN_FLIGHT})."
+    )
+    parser.add_argument(
+        "-v", "--verbose",
+        action="store_true",
+        help="List every part file created."
+    )
 
     args = parser.parse_args()
     
     try:
         source_path = Path(args.file)
-        split_file(source_path, args.num_parts)
+        split_file(source_path, args.num_parts, aggregate=args.aggregate, workers=args.workers, verbose=args.verbose)
     except (FileNotFoundError, ValueError) as e:
         print(e)
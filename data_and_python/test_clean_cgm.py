@@ -0,0 +1,78 @@
+# file: test_clean_cgm.py
+
+import unittest
+import io
+import shutil
+from contextlib import redirect_stdout
+from pathlib import Path
+from unittest import mock
+
+import clean_cgm
+
+# A small FreeStyle Libre export: a metadata line, the header, then rows in file order
+EXPORT_LINES = [
+    "Glucose Data,Generated on,18-06-2025 21:00 UTC,Generated by,X",
+    "Device,Serial Number,Device Timestamp,Record Type,Historic Glucose mmol/L,Scan Glucose mmol/L,Notes",
+    "FreeStyle LibreLink,abc,18-06-2025 19:05,1,,6.6,,note,extra", # Extra trailing fields
+    "FreeStyle LibreLink,abc,18-06-2025 18:50,1,,5.8,",
+    "FreeStyle LibreLink,abc,18-06-2025 18:49,1,,7", # One field short, but both columns present
+    "FreeStyle LibreLink,abc,18-06-2025 18:47,1,,4.1,", # Start of the window is exclusive
+    "FreeStyle LibreLink,abc,18-06-2025 19:27,1,,4.40,", # End of the window is inclusive
+    "FreeStyle LibreLink,abc,18-06-2025 19:28,1,,4.9,",
+    "FreeStyle LibreLink,abc,18-06-2025 19:00,0,5.5,,", # Historic reading, no scan
+    "FreeStyle LibreLink,abc,18-06-2025 19:01,1,,abc,", # Malformed glucose
+    "FreeStyle LibreLink,abc,18-06-2025 19:02,1,, 1e1 ,",
+    "",
+    "FreeStyle LibreLink,abc,18-06-2025 19:03,1", # Too short to hold the scan column
+]
+
+# What the original csv.reader implementation wrote for EXPORT_LINES
+EXPECTED_REPORT = (
+    "Device Timestamp,Scan Glucose (mmol/L)\r\n"
+    "18-06-2025 18:49,7.0\r\n"
+    "18-06-2025 18:50,5.8\r\n"
+    "18-06-2025 19:02,10.0\r\n"
+    "18-06-2025 19:05,6.6\r\n"
+    "18-06-2025 19:27,4.4\r\n"
+)
+
+class TestGenerateScanReport(unittest.TestCase):
+
+    def setUp(self):
+        """Write the export to a per-test directory and point the script's file names at it."""
+        self.test_dir = Path("temp_cgm_test_data") / self._testMethodName
+        self.test_dir.mkdir(parents=True)
+        self.input_file = self.test_dir / "readings.csv"
+        self.output_file = self.test_dir / "report.csv"
+        self.input_file.write_text("\n".join(EXPORT_LINES) + "\n", encoding="utf-8")
+
+        for name, value in (("INPUT_FILENAME", self.input_file), ("OUTPUT_FILENAME", self.output_file)):
+            patcher = mock.patch.object(clean_cgm, name, str(value))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        """Clean up the per-test directory after each test."""
+        shutil.rmtree(self.test_dir.parent)
+
+    def test_report_matches_original_output(self):
+        """The report should keep, sort and format the same rows the original script did."""
+        output = io.StringIO()
+        with redirect_stdout(output):
+            clean_cgm.generate_scan_report()
+
+        self.assertEqual(self.output_file.read_bytes().decode("utf-8"), EXPECTED_REPORT)
+        self.assertIn("Skipping 2 malformed row(s)", output.getvalue())
+
+    def test_missing_input_is_reported(self):
+        """A missing export should be reported without writing a report."""
+        self.input_file.unlink()
+        output = io.StringIO()
+        with redirect_stdout(output):
+            clean_cgm.generate_scan_report()
+
+        self.assertIn("was not found", output.getvalue())
+        self.assertFalse(self.output_file.exists())
+
+if __name__ == "__main__":
+    unittest.main()
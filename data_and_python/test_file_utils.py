@@ -1,40 +1,71 @@
 # file: test_file_utils.py
 
 import unittest
-import hashlib
 import os
+import random
 from pathlib import Path
 import shutil
 
 # Import the functions to be tested
 from split_file import split_file
+from file_parts import CONTAINER_HEADER, CONTAINER_MAGIC
 from reconstruct_file import reconstruct_file
+from verify_integrity import (
+    DEFAULT_HASH_ALGORITHM, HAVE_BLAKE3, PROBE_BLOCK_SIZE,
+    compare_files, file_hexdigest, hash_files, probe_blocks_equal, probe_offsets
+)
+
+FIXTURE_SEED = 0xC0FFEE
+# The fastest available checksum; see DEFAULT_HASH_ALGORITHM in verify_integrity.py
+HASH_ALGORITHM = "blake3" if HAVE_BLAKE3 else DEFAULT_HASH_ALGORITHM
 
 class TestFileSplitterReconstructor(unittest.TestCase):
 
-    def setUp(self):
-        """Set up a temporary directory and test files before each test."""
-        self.test_dir = Path("temp_test_data")
-        self.test_dir.mkdir(exist_ok=True)
-        
+    @classmethod
+    def setUpClass(cls):
+        """Create and hash the shared test file once for the whole class."""
+        cls.fixture_dir = Path("temp_test_data")
+        cls.fixture_dir.mkdir(exist_ok=True)
+
         # Create a test file with a size that is not easily divisible
-        self.original_file = self.test_dir / "original_test_file.bin"
-        with open(self.original_file, "wb") as f:
-            f.write(os.urandom(1024 * 100 + 13)) # 100KB + 13 bytes
-            
-        self.original_hash = self._get_file_hash(self.original_file)
+        cls.fixture_file = cls.fixture_dir / "original_test_file.bin"
+        # Seeded PRNG bytes: incompressible like os.urandom, but cheaper and reproducible between runs
+        with open(cls.fixture_file, "wb") as f:
+            f.write(random.Random(FIXTURE_SEED).randbytes(1024 * 100 + 13)) # 100KB + 13 bytes
+
+        cls.original_hash = cls._get_file_hash(cls.fixture_file)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Clean up the temporary directory after all tests."""
+        shutil.rmtree(cls.fixture_dir)
+
+    def setUp(self):
+        """Give each test its own directory holding a link to the shared test file."""
+        self.test_dir = self.fixture_dir / self._testMethodName
+        self.test_dir.mkdir()
+
+        # The tests only read the original, so a hard link is enough (copy where links are unsupported)
+        self.original_file = self.test_dir / self.fixture_file.name
+        try:
+            os.link(self.fixture_file, self.original_file)
+        except OSError:
+            shutil.copyfile(self.fixture_file, self.original_file)
 
     def tearDown(self):
-        """Clean up the temporary directory after each test."""
+        """Clean up the per-test directory after each test."""
         shutil.rmtree(self.test_dir)
 
-    def _get_file_hash(self, file_path: Path) -> str:
-        """Computes the SHA256 hash of a file."""
-        sha256 = hashlib.sha256()
+    @staticmethod
+    def _get_file_hash(file_path: Path) -> str:
+        """Computes the checksum of a file."""
         with open(file_path, "rb") as f:
-            while chunk := f.read(8192):
-                sha256.update(chunk)
-        return sha256.hexdigest()
+            return file_hexdigest(f, HASH_ALGORITHM)
+
+    def _list_parts(self) -> list[str]:
+        """Returns the names of the part files in the test directory (one scandir pass, no per-entry stat)."""
+        with os.scandir(self.test_dir) as entries:
+            return [entry.name for entry in entries if "_part" in entry.name and "_of_" in entry.name]
 
     def test_split_and_reconstruct_integrity(self):
         """The ultimate test: does a reconstructed file match the original?"""
@@ -44,7 +75,7 @@ class TestFileSplitterReconstructor(unittest.TestCase):
         split_file(self.original_file, num_parts)
         
         # 2. Check that the correct number of parts were created
-        parts = list(self.test_dir.glob("*_part*_of_*"))
+        parts = self._list_parts()
         self.assertEqual(len(parts), num_parts)
         
         # 3. Reconstruct the file from the first part
@@ -55,6 +86,7 @@ class TestFileSplitterReconstructor(unittest.TestCase):
         reconstructed_file = self.test_dir / "original_test_file_reconstructed.bin"
         self.assertTrue(reconstructed_file.exists())
         
+        # The original was already hashed in setUpClass, so only the reconstruction is read here
         reconstructed_hash = self._get_file_hash(reconstructed_file)
         self.assertEqual(self.original_hash, reconstructed_hash, "File content mismatch after reconstruction!")
 
@@ -72,5 +104,115 @@ class TestFileSplitterReconstructor(unittest.TestCase):
         with self.assertRaises(FileNotFoundError):
             reconstruct_file(first_part)
 
+    def test_aggregate_container_round_trip(self):
+        """An aggregated container should reconstruct to the original file."""
+        split_file(self.original_file, 4, aggregate=True)
+
+        # Only the container is written, not separate part files
+        self.assertEqual(self._list_parts(), [])
+        container = self.test_dir / "original_test_file.bin.parts"
+        reconstruct_file(container)
+
+        reconstructed_file = self.test_dir / "original_test_file_reconstructed.bin"
+        self.assertEqual(self.original_hash, self._get_file_hash(reconstructed_file))
+
+    def test_reconstruct_rejects_truncated_container(self):
+        """A container cut short (e.g. an interrupted download) must not reconstruct silently."""
+        split_file(self.original_file, 4, aggregate=True)
+        container = self.test_dir / "original_test_file.bin.parts"
+        os.truncate(container, container.stat().st_size - 1)
+
+        with self.assertRaises(ValueError):
+            reconstruct_file(container)
+
+    def test_reconstruct_rejects_corrupt_part_count(self):
+        """A part count larger than the container can hold must be reported, not allocated."""
+        split_file(self.original_file, 4, aggregate=True)
+        container = self.test_dir / "original_test_file.bin.parts"
+        with open(container, "r+b") as f:
+            f.write(CONTAINER_HEADER.pack(CONTAINER_MAGIC, 0xFFFFFFF0))
+
+        with self.assertRaises(ValueError):
+            reconstruct_file(container)
+
+    def test_compare_against_known_hash(self):
+        """A reconstruction should verify against the original's hash alone."""
+        split_file(self.original_file, 3)
+        reconstruct_file(self.test_dir / "original_test_file_part1_of_3.bin")
+
+        reconstructed_file = self.test_dir / "original_test_file_reconstructed.bin"
+        missing_original = self.test_dir / "not_downloaded.bin"
+        self.assertTrue(compare_files(missing_original, reconstructed_file, expected_hash1=self.original_hash, algorithm=HASH_ALGORITHM))
+        self.assertFalse(compare_files(missing_original, reconstructed_file, expected_hash1="0" * len(self.original_hash), algorithm=HASH_ALGORITHM))
+
+    def test_hash_files_keeps_input_order(self):
+        """hash_files should return one digest per open file, in the order the files were given."""
+        other = self._write_variant("other.bin", b"not the original")
+        with open(self.original_file, "rb") as f1, open(other, "rb") as f2, open(self.original_file, "rb") as f3:
+            hashes = hash_files([f1, f2, f3], HASH_ALGORITHM)
+        self.assertEqual(hashes, [self.original_hash, self._get_file_hash(other), self.original_hash])
+
+    def _write_variant(self, name: str, data: bytes) -> Path:
+        """Writes `data` to a new file in the test directory and returns its path."""
+        path = self.test_dir / name
+        path.write_bytes(data)
+        return path
+
+    def test_compare_identical_files(self):
+        """An exact copy should compare equal."""
+        copy = self._write_variant("copy.bin", self.original_file.read_bytes())
+        self.assertTrue(compare_files(self.original_file, copy))
+
+    def test_compare_files_differing_in_last_byte(self):
+        """A change in the very last byte must not slip past the comparison."""
+        data = bytearray(self.original_file.read_bytes())
+        data[-1] ^= 0xFF
+        modified = self._write_variant("modified.bin", data)
+        self.assertFalse(compare_files(self.original_file, modified))
+
+    def test_compare_files_of_different_sizes(self):
+        """Files of different sizes should never compare equal, even with a common prefix."""
+        truncated = self._write_variant("truncated.bin", self.original_file.read_bytes()[:-1])
+        self.assertFalse(compare_files(self.original_file, truncated))
+
+    def test_compare_files_by_hash(self):
+        """The hash comparison should agree with the direct one."""
+        data = bytearray(self.original_file.read_bytes())
+        copy = self._write_variant("copy.bin", data)
+        data[-1] ^= 0xFF
+        modified = self._write_variant("modified.bin", data)
+        self.assertTrue(compare_files(self.original_file, copy, use_hash=True, algorithm=HASH_ALGORITHM))
+        self.assertFalse(compare_files(self.original_file, modified, use_hash=True, algorithm=HASH_ALGORITHM))
+
+    def _write_with_byte_flipped(self, offset: int) -> Path:
+        """Writes a copy of the original with the byte at `offset` flipped."""
+        data = bytearray(self.original_file.read_bytes())
+        data[offset] ^= 0xFF
+        return self._write_variant("modified.bin", data)
+
+    def test_probe_rejects_difference_in_probed_block(self):
+        """A difference inside a sampled block should be caught by the probe alone."""
+        size = self.original_file.stat().st_size
+        offsets = probe_offsets(size)
+        self.assertTrue(offsets, "the fixture should be large enough to be probed")
+        modified = self._write_with_byte_flipped(offsets[0])
+
+        with open(self.original_file, "rb") as f1, open(modified, "rb") as f2:
+            self.assertFalse(probe_blocks_equal(f1, f2, size))
+        self.assertFalse(compare_files(self.original_file, modified))
+
+    def test_full_compare_catches_difference_outside_probes(self):
+        """A difference the probes miss must still be found by the full comparison."""
+        size = self.original_file.stat().st_size
+        offsets = probe_offsets(size)
+        self.assertTrue(offsets, "the fixture should be large enough to be probed")
+        unprobed = next(offset for offset in range(0, size, PROBE_BLOCK_SIZE) if offset not in offsets)
+        modified = self._write_with_byte_flipped(unprobed)
+
+        with open(self.original_file, "rb") as f1, open(modified, "rb") as f2:
+            self.assertTrue(probe_blocks_equal(f1, f2, size))
+        self.assertFalse(compare_files(self.original_file, modified))
+        self.assertFalse(compare_files(self.original_file, modified, use_hash=True, algorithm=HASH_ALGORITHM))
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,70 @@
+# file: test_fnirs_features.py
+
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from fnirs_features import EPOCH_STATISTICS, compute_epoch_features, epoch_features_kernel
+
+FIXTURE_SEED = 0xC0FFEE
+SAMPLES_EPOCH = 8
+STEP = 4
+
+def make_hb() -> np.ndarray:
+    """Builds float32 channels covering the awkward cases: NaN gaps, constant and nearly empty windows."""
+    rng = np.random.default_rng(FIXTURE_SEED)
+    n_samples = 40
+    sparse = np.arange(n_samples) % 3 != 0 # Leaves 2-3 valid samples per epoch
+    gaps = rng.random(n_samples) < 0.3
+    columns = [
+        rng.normal(size=n_samples),
+        np.where(gaps, np.nan, rng.normal(size=n_samples)),
+        np.full(n_samples, 1.5),
+        np.where(gaps, np.nan, 1.5),
+        np.where(sparse, np.nan, rng.normal(size=n_samples)),
+        np.where(sparse, np.nan, 2.0),
+        np.full(n_samples, np.nan),
+    ]
+    return np.ascontiguousarray(np.stack(columns, axis=1), dtype=np.float32)
+
+def pandas_epoch_features(hb: np.ndarray) -> np.ndarray:
+    """Reference statistics computed epoch by epoch with pandas, in EPOCH_STATISTICS order."""
+    epochs = []
+    for start in range(0, len(hb) - SAMPLES_EPOCH + 1, STEP):
+        window = pd.DataFrame(hb[start:start + SAMPLES_EPOCH], dtype=np.float64)
+        stats = [window.mean(), window.std(), window.skew(), window.kurt(), window.max() - window.min()]
+        epochs.append(np.stack(stats, axis=-1))
+    return np.array(epochs)
+
+class TestEpochFeatures(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.hb = make_hb()
+        cls.expected = pandas_epoch_features(cls.hb)
+
+    def test_fixture_has_small_count_windows(self):
+        """The fixture should really contain windows with too few samples for skew or kurtosis."""
+        self.assertTrue(np.isnan(self.expected[..., EPOCH_STATISTICS.index('kurtosis')]).any())
+        self.assertTrue((self.expected[..., EPOCH_STATISTICS.index('skew')] == 0).any())
+
+    def test_compute_epoch_features_matches_pandas(self):
+        """The vectorized statistics should equal pandas', including where pandas returns NaN."""
+        features = compute_epoch_features(self.hb, SAMPLES_EPOCH, STEP)
+        np.testing.assert_allclose(features, self.expected, rtol=1e-6, atol=1e-9, equal_nan=True)
+
+    def test_epoch_features_kernel_matches_pandas(self):
+        """The compiled kernel (plain Python without numba) should agree with pandas as well."""
+        features = epoch_features_kernel(self.hb, SAMPLES_EPOCH, STEP)
+        np.testing.assert_allclose(features, self.expected, rtol=1e-6, atol=1e-9, equal_nan=True)
+
+    def test_compute_epoch_features_subset(self):
+        """Requesting a subset of the statistics should return just those, in the requested order."""
+        names = ('max_minus_min', 'mean')
+        features = compute_epoch_features(self.hb, SAMPLES_EPOCH, STEP, names)
+        columns = [EPOCH_STATISTICS.index(name) for name in names]
+        np.testing.assert_allclose(features, self.expected[..., columns], rtol=1e-6, atol=1e-9, equal_nan=True)
+
+if __name__ == "__main__":
+    unittest.main()
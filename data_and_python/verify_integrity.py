@@ -2,53 +2,177 @@
 
 import argparse
 import hashlib
+import mmap
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import sys
 
-def get_file_hash(file_path: Path) -> str:
-    """Computes and returns the SHA256 hash of a file."""
-    sha256 = hashlib.sha256()
-    
+try:
+    import blake3
+    HAVE_BLAKE3 = True
+except ImportError:
+    HAVE_BLAKE3 = False
+
+HASH_CHUNK_SIZE = 1024 * 1024 # Read buffer for blake3, and for hashlib before Python 3.11 (no file_digest)
+COMPARE_WINDOW_SIZE = 16 * 1024 * 1024 # Bytes compared per slice of the memory-mapped files
+PROBE_COUNT = 16 # Randomly chosen blocks compared before reading whole files
+PROBE_BLOCK_SIZE = 4096
+PROBE_SEED = 0 # Fixed so repeated runs (and CI) probe the same offsets
+# sha256 stays the default so digests match existing manifests. hashlib's OpenSSL backend already runs it
+# on the CPU's SHA extensions (SHA-NI / ARMv8 SHA2) when present, so no extra package is needed for that;
+# blake3 (optional package, SIMD and multi-threaded) is faster when installed.
+HASH_ALGORITHMS = ("sha256", "blake2b", "blake3")
+DEFAULT_HASH_ALGORITHM = "sha256"
+
+def file_hexdigest(file_obj, algorithm: str = DEFAULT_HASH_ALGORITHM) -> str:
+    """
+    Returns the hex digest of a binary file object, reading it to the end.
+
+    Raises:
+        ValueError: If the algorithm is unknown, or is 'blake3' without the blake3 package.
+    """
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"Error: Unsupported hash algorithm '{algorithm}'.")
+    if algorithm == "blake3":
+        if not HAVE_BLAKE3:
+            raise ValueError("Error: The 'blake3' algorithm needs the blake3 package (pip install blake3).")
+        hasher = blake3.blake3(max_threads=blake3.blake3.AUTO)
+    elif hasattr(hashlib, "file_digest"): # Python 3.11+: C loop over a reused buffer
+        return hashlib.file_digest(file_obj, algorithm).hexdigest()
+    else:
+        hasher = hashlib.new(algorithm)
+
+    buffer = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buffer)
+    while size := file_obj.readinto(buffer):
+        hasher.update(view[:size])
+    return hasher.hexdigest()
+
+def get_file_hash(file_path: Path, algorithm: str = DEFAULT_HASH_ALGORITHM) -> str:
+    """Computes and returns the hash of a file (SHA256 by default)."""
     try:
         with open(file_path, "rb") as f:
-            # Read the file in chunks to handle large files efficiently
-            while chunk := f.read(8192):
-                sha256.update(chunk)
+            return file_hexdigest(f, algorithm)
     except IOError as e:
         print(f"Error reading file '{file_path}': {e}", file=sys.stderr)
         return ""
-        
-    return sha256.hexdigest()
 
-def compare_files(file1_path: Path, file2_path: Path) -> bool:
+def hash_files(files: list, algorithm: str = DEFAULT_HASH_ALGORITHM) -> list[str]:
+    """
+    Hashes several open binary files concurrently, from their current position, returned in the order given.
+
+    hashlib releases the GIL while hashing large buffers, so independent files are hashed in parallel threads.
+    """
+    if len(files) <= 1:
+        return [file_hexdigest(f, algorithm) for f in files]
+    with ThreadPoolExecutor(max_workers=min(len(files), os.cpu_count() or 1)) as pool:
+        return list(pool.map(file_hexdigest, files, [algorithm] * len(files)))
+
+def read_block(file_obj, offset: int, size: int) -> bytes:
+    """Reads up to `size` bytes at `offset`, without moving the file position where os.pread exists."""
+    if hasattr(os, "pread"):
+        return os.pread(file_obj.fileno(), size, offset)
+    file_obj.seek(offset)
+    return file_obj.read(size)
+
+def probe_offsets(size: int) -> list[int]:
+    """
+    Returns the sorted, block-aligned offsets of the PROBE_BLOCK_SIZE blocks sampled in a `size`-byte file.
+
+    Empty when the file has at most PROBE_COUNT blocks, since the full comparison is then just as cheap.
+    """
+    num_blocks = -(-size // PROBE_BLOCK_SIZE)
+    if num_blocks <= PROBE_COUNT:
+        return []
+    rng = random.Random(PROBE_SEED)
+    return sorted(rng.randrange(num_blocks) * PROBE_BLOCK_SIZE for _ in range(PROBE_COUNT))
+
+def probe_blocks_equal(file1, file2, size: int) -> bool:
+    """
+    Compares the blocks chosen by probe_offsets in two open files of `size` bytes.
+
+    Returns False as soon as a probed block differs, so most different files are rejected after
+    a few KiB of I/O. True only means the probes matched; a full comparison is still needed.
+    """
+    for offset in probe_offsets(size):
+        if read_block(file1, offset, PROBE_BLOCK_SIZE) != read_block(file2, offset, PROBE_BLOCK_SIZE):
+            return False
+    return True
+
+def files_equal(file1, file2, size: int) -> bool:
+    """
+    Compares two open files of `size` bytes directly, stopping at the first differing window.
+
+    Both files are memory-mapped and compared in COMPARE_WINDOW_SIZE slices (a C memcmp each),
+    so identical files cost one pass over memory and different ones usually exit almost immediately.
+    """
+    if size == 0:
+        return True
+    with mmap.mmap(file1.fileno(), 0, access=mmap.ACCESS_READ) as m1, \
+         mmap.mmap(file2.fileno(), 0, access=mmap.ACCESS_READ) as m2:
+        for offset in range(0, size, COMPARE_WINDOW_SIZE):
+            if m1[offset:offset + COMPARE_WINDOW_SIZE] != m2[offset:offset + COMPARE_WINDOW_SIZE]:
+                return False
+    return True
+
+def compare_files(
+    file1_path: Path | None, file2_path: Path, use_hash: bool = False, *,
+    expected_hash1: str | None = None, algorithm: str = DEFAULT_HASH_ALGORITHM
+) -> bool:
     """
     Compares two files for byte-for-byte identity.
     
-    First, it checks if the file sizes are identical.
-    If they are, it proceeds to compare their SHA256 hashes.
+    First, it checks if the file sizes are identical and a few sampled blocks match.
+    If they do, it compares the contents directly, or their hashes (`algorithm`, SHA256 by default) when
+    `use_hash` is set (e.g. to print digests that can be checked on another machine).
+    Each file is opened once and its size taken from the open descriptor.
+
+    If `expected_hash1` (a known hash of the first file, e.g. from a manifest) is given,
+    the first file is not read at all (`file1_path` may be None): only the second one is hashed
+    and compared against it.
     
     Returns:
         True if files are identical, False otherwise.
     """
+    if expected_hash1 is not None:
+        expected_hash1 = expected_hash1.strip().lower()
+        print(f"Comparing '{file2_path.name}' against the provided hash...")
+        hash2 = get_file_hash(file2_path, algorithm)
+        if not hash2:
+            return False # An error occurred during hashing
+
+        print(f"  -> Hash 1: {expected_hash1} (provided)")
+        print(f"  -> Hash 2: {hash2}")
+        return expected_hash1 == hash2
+
     try:
-        # Quick check: Compare file sizes first.
-        size1 = file1_path.stat().st_size
-        size2 = file2_path.stat().st_size
-
-        if size1 != size2:
-            print(f"File sizes do not match:")
-            print(f"  -> {file1_path.name}: {size1} bytes")
-            print(f"  -> {file2_path.name}: {size2} bytes")
-            return False
+        with open(file1_path, "rb", buffering=0) as f1, open(file2_path, "rb", buffering=0) as f2:
+            # Quick check: Compare file sizes first.
+            size1 = os.fstat(f1.fileno()).st_size
+            size2 = os.fstat(f2.fileno()).st_size
 
-        print("File sizes match. Comparing hashes...")
-        
-        # Comprehensive check: Compare hashes.
-        hash1 = get_file_hash(file1_path)
-        hash2 = get_file_hash(file2_path)
-        
-        if not hash1 or not hash2:
-            return False # An error occurred during hashing
+            if size1 != size2:
+                print(f"File sizes do not match:")
+                print(f"  -> {file1_path.name}: {size1} bytes")
+                print(f"  -> {file2_path.name}: {size2} bytes")
+                return False
+
+            if not probe_blocks_equal(f1, f2, size1):
+                print("File sizes match, but sampled blocks differ.")
+                return False
+
+            if not use_hash:
+                print("File sizes match. Comparing contents...")
+                return files_equal(f1, f2, size1)
+
+            print(f"File sizes match. Comparing {algorithm} hashes...")
+
+            # Comprehensive check: Compare hashes of both files, computed concurrently.
+            f1.seek(0)
+            f2.seek(0)
+            hash1, hash2 = hash_files([f1, f2], algorithm)
 
         print(f"  -> Hash 1: {hash1}")
         print(f"  -> Hash 2: {hash2}")
@@ -58,23 +182,53 @@ def compare_files(file1_path: Path, file2_path: Path) -> bool:
     except FileNotFoundError as e:
         print(f"Error: {e}", file=sys.stderr)
         return False
+    except (OSError, ValueError) as e:
+        print(f"Error reading files: {e}", file=sys.stderr)
+        return False
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
-        description="Verify that two files are byte-for-byte identical by comparing their SHA256 hashes."
+        description="Verify that two files are byte-for-byte identical."
+    )
+    parser.add_argument(
+        "file1",
+        nargs="?",
+        help="Path to the first file (e.g., the original). Not needed with --hash1."
     )
-    parser.add_argument("file1", help="Path to the first file (e.g., the original).")
     parser.add_argument("file2", help="Path to the second file (e.g., the reconstructed one).")
+    parser.add_argument(
+        "--hash",
+        action="store_true",
+        help="Compare hashes instead of the raw bytes and print them."
+    )
+    parser.add_argument(
+        "--hash1",
+        metavar="HEX",
+        help="Known hash of the original (e.g. from a manifest); file1 can then be omitted, only file2 is hashed."
+    )
+    parser.add_argument(
+        "--algo",
+        choices=HASH_ALGORITHMS,
+        default=DEFAULT_HASH_ALGORITHM,
+        help=f"Hash algorithm for --hash/--hash1 (default: {DEFAULT_HASH_ALGORITHM}; blake3 needs the blake3 package)."
+    )
     
     args = parser.parse_args()
+    if args.algo == "blake3" and not HAVE_BLAKE3:
+        parser.error("--algo blake3 needs the blake3 package (pip install blake3).")
+    if args.file1 is None and args.hash1 is None:
+        parser.error("file1 is required unless --hash1 is given.")
 
-    path1 = Path(args.file1)
+    path1 = Path(args.file1) if args.hash1 is None else None
     path2 = Path(args.file2)
     
-    print(f"Verifying integrity between '{path1.name}' and '{path2.name}'...\n")
+    if path1 is None:
+        print(f"Verifying integrity of '{path2.name}' against the provided hash...\n")
+    else:
+        print(f"Verifying integrity between '{path1.name}' and '{path2.name}'...\n")
 
-    if compare_files(path1, path2):
+    if compare_files(path1, path2, use_hash=args.hash, expected_hash1=args.hash1, algorithm=args.algo):
         print("\n✅ SUCCESS: Files are identical.")
         # Exit with a success code
         sys.exit(0)